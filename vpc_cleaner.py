@@ -13,235 +13,584 @@
     cluster name. Therefore it's recommended that your cluster name includes
     an unambiguous substring such as your name.
 
-    Optional arguments are dry run, region setting and your AWS profile name
-    which you should be able to snag from ~/.aws/credentials in a default
-    config. Don't forget to renew this with MAWS if appropriate.
+    Optional arguments are dry run, quiet (failures only), region setting and
+    your AWS profile name which you should be able to snag from
+    ~/.aws/credentials in a default config. Don't forget to renew this with MAWS if appropriate.
 """
 # ---------------------------------------------------------------------------
 
 import sys
+import time
 import boto3
 import argparse
-from botocore.exceptions import ClientError
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from botocore.config import Config
+from botocore.exceptions import ClientError, WaiterError
 from colorama import Fore
 
 
-# Parse user arguments and assign to vars
+# The work is all blocking HTTPS round trips to AWS, so threads spend their time waiting on sockets
+MAX_WORKERS = 16
+pool = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
-parser = argparse.ArgumentParser(description='Finds an AWS VPC based upon wildcard term search and deletes it with '
-                                             'all its dependencies')
-parser.add_argument('-f', '--filter-term', help='Provide a search term for object names, ie whitehouse. Do not use '
-                                                'regex or add wildcard characters', required=True)
-parser.add_argument('-r', '--aws-region', help='Define AWS region, ie us-west-2', default='us-west-2')
-parser.add_argument('-d', '--dry-run', help='Dry run only', default=False, action='store_true')
-parser.add_argument('-p', '--profile-name', help='AWS Profile name, ie 222638339470_Mesosphere-PowerUser',
-                    default='222638339470_Mesosphere-PowerUser')
-args = parser.parse_args()
-dry_run = args.dry_run
-aws_region = args.aws_region
-filter_term = args.filter_term
-profile_name = args.profile_name
+# One config shared by every client. The connection pool is kept at twice the worker count so the threads never
+# queue for a connection, keep-alive holds the warm TLS connections open between calls and adaptive retries
+# share a token bucket across the client, backing every thread off together when EC2 starts throttling
+boto_config = Config(tcp_keepalive=True, max_pool_connections=MAX_WORKERS * 2,
+                     retries={'mode': 'adaptive', 'max_attempts': 10})
 
-# Instantiate an AWS client
-boto3.setup_default_session(profile_name='222638339470_Mesosphere-PowerUser')
-ec2 = boto3.resource('ec2', region_name=aws_region)
-client = boto3.client("ec2", region_name=aws_region)
-ec2client = ec2.meta.client
+# Status strings are put together once here rather than concatenated for every resource we touch
+OK = Fore.GREEN + "Successfully Completed" + Fore.RESET
+ERR = Fore.RED
+END = Fore.RESET
 
-# Search by filter for the cluster name and add the vpc Ids to an array
-try:
-    filt = [{'Name': 'tag:Name', 'Values': [f"*{filter_term}*"]}]
-    vpcs = list(ec2.vpcs.filter(Filters=filt))
-except ClientError as e:
-    print(Fore.RED + "Unable to connect to AWS - check that you have valid creds. Refresh if necessary." + Fore.RESET)
-    sys.exit()
+logger = logging.getLogger('decrufter')
 
+# Most of the EC2 bulk calls cap out at 1000 ids per request, and most of the describes at 1000 results a page
+MAX_BATCH = 1000
 
-def vpc_cleanup(vpcid):
+# There's no botocore waiter for vpc endpoints, so we poll them on the same schedule the ec2 waiters use
+ENDPOINT_POLL_DELAY = 15
+ENDPOINT_POLL_ATTEMPTS = 40
+
+# Tag key used to mark elastic ips with the vpc they were released from, in case the release doesn't happen
+EIP_TAG = 'decrufter:vpc-id'
+
+# The describes that won't go as high as MAX_BATCH in a single page
+PAGE_SIZES = {'describe_route_tables': 100}
+
+# Every describe the cleanup makes - the key its results come back under, the filter that ties it to a single
+# vpc and the parameter that filter goes in
+VPC_DESCRIBES = {
+    'describe_subnets': ('Subnets', 'vpc-id', 'Filters'),
+    'describe_instances': ('Reservations', 'vpc-id', 'Filters'),
+    'describe_network_interfaces': ('NetworkInterfaces', 'vpc-id', 'Filters'),
+    'describe_route_tables': ('RouteTables', 'vpc-id', 'Filters'),
+    'describe_internet_gateways': ('InternetGateways', 'attachment.vpc-id', 'Filters'),
+    'describe_nat_gateways': ('NatGateways', 'vpc-id', 'Filter'),
+    'describe_vpc_endpoints': ('VpcEndpoints', 'vpc-id', 'Filters'),
+    'describe_security_groups': ('SecurityGroups', 'vpc-id', 'Filters'),
+    'describe_vpc_peering_connections': ('VpcPeeringConnections', 'requester-vpc-info.vpc-id', 'Filters'),
+    'describe_network_acls': ('NetworkAcls', 'vpc-id', 'Filters'),
+}
+
+# The describes taken as a snapshot before anything is deleted
+SNAPSHOT_DESCRIBES = ('describe_subnets', 'describe_instances', 'describe_network_interfaces')
+
+
+class ColourFormatter(logging.Formatter):
+    """
+    Paints warnings and errors red. The colour only goes on records that make it past the level check
+    """
+    def format(self, record):
+        message = super().format(record)
+        if record.levelno >= logging.WARNING:
+            return f"{ERR}{message}{END}"
+        return message
+
+
+class StatusHandler(logging.StreamHandler):
+    """
+    Stream handler that leaves flushing to us, so the status lines batch up in stdout until a vpc is done
+    """
+    def flush(self):
+        pass
+
+
+def parse_args():
+    """
+    Parse user arguments
+    """
+    parser = argparse.ArgumentParser(description='Finds an AWS VPC based upon wildcard term search and deletes it '
+                                                 'with all its dependencies')
+    parser.add_argument('-f', '--filter-term', help='Provide a search term for object names, ie whitehouse. Do not '
+                                                    'use regex or add wildcard characters', required=True)
+    parser.add_argument('-r', '--aws-region', help='Define AWS region, ie us-west-2', default='us-west-2')
+    parser.add_argument('-d', '--dry-run', help='Dry run only', default=False, action='store_true')
+    parser.add_argument('-q', '--quiet', help='Only report failures', default=False, action='store_true')
+    parser.add_argument('-p', '--profile-name', help='AWS Profile name, ie 222638339470_Mesosphere-PowerUser',
+                        default='222638339470_Mesosphere-PowerUser')
+    return parser.parse_args()
+
+
+def chunked(items, size):
+    """
+    Split a list of ids into batches no bigger than the API will accept in one call
+    """
+    iterator = iter(items)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def run_parallel(jobs, retried=False):
+    """
+    Fire a batch of (description, callable) jobs at the thread pool and report on each one as it lands.
+    A ClientError in one job doesn't cancel the rest of the batch. Returns the descriptions that failed.
+    Pass retried when the caller has another go at the failures itself, so they're only logged at debug
+    and the caller reports whatever is still failing after that
+    """
+    futures = [(description, pool.submit(job)) for description, job in jobs]
+    failures = []
+    for description, future in futures:
+        error = future.exception()
+        if error is None:
+            logger.info("%s: %s", OK, description)
+        elif isinstance(error, ClientError):
+            logger.log(logging.DEBUG if retried else logging.ERROR, "Failed: %s - %s", description, error)
+            failures.append(description)
+        else:
+            raise error
+    return failures
+
+
+def find_vpcs(rgta, filter_term):
+    """
+    Ask the tagging api for the vpcs whose Name tag contains the filter term. It only hands back ARNs, so
+    there's no per vpc describe to pay for. Tag values can't be wildcarded on that api, so we pull every
+    named vpc and do the substring match ourselves
+    """
+    pages = rgta.get_paginator('get_resources').paginate(TagFilters=[{'Key': 'Name'}], ResourceTypeFilters=['ec2:vpc'])
+    return [mapping['ResourceARN'].rsplit('/', 1)[1]
+            for page in pages
+            for mapping in page['ResourceTagMappingList']
+            if any(tag['Key'] == 'Name' and filter_term in tag['Value'] for tag in mapping['Tags'])]
+
+
+def describe_in_vpc(ec2client, operation, vpcid):
+    """
+    Page through a Describe* call filtered server side to the VPC and hand back the raw dicts it returns.
+    Working off the raw dicts spares us the lazy reloads the resource layer does on attribute access, and
+    asking for the largest page the api allows keeps the number of round trips down
+    """
+    key, filter_name, filter_param = VPC_DESCRIBES[operation]
+    paginator = ec2client.get_paginator(operation)
+    pages = paginator.paginate(**{filter_param: [{'Name': filter_name, 'Values': [vpcid]}]},
+                               PaginationConfig={'PageSize': PAGE_SIZES.get(operation, MAX_BATCH)})
+    return [item for page in pages for item in page[key]]
+
+
+def vpc_eips(interfaces, addresses, vpcid):
+    """
+    Work out which elastic ips to release - anything associated with one of the vpc's interfaces, whether on
+    the primary or a secondary private ip, plus any address an earlier run tagged as belonging to this vpc.
+    The tag is what picks up addresses that run managed to disassociate but not release
+    """
+    eips = {private_ip['Association']['AllocationId']
+            for interface in interfaces
+            for private_ip in [interface] + interface.get('PrivateIpAddresses', [])
+            if 'AllocationId' in private_ip.get('Association', {})}
+    interface_ids = {interface['NetworkInterfaceId'] for interface in interfaces}
+    for address in addresses:
+        if address.get('NetworkInterfaceId') in interface_ids or any(
+                tag['Key'] == EIP_TAG and tag['Value'] == vpcid for tag in address.get('Tags', [])):
+            eips.add(address['AllocationId'])
+    return sorted(eips)
+
+
+def wait_for(ec2client, waiter_name, id_param, ids):
+    """
+    Block until the given resources reach the waiter's state, a batch at a time. If the waiter gives up we
+    say so and carry on - whatever the stragglers hold up will report its own failure
+    """
+    if not ids:
+        return
+    logger.info("Waiting on %s for %s resources", waiter_name, len(ids))
+    sys.stdout.flush()
+    waiter = ec2client.get_waiter(waiter_name)
+    for batch in chunked(ids, MAX_BATCH):
+        try:
+            waiter.wait(**{id_param: batch})
+        except WaiterError as e:
+            logger.error("Gave up waiting on %s for %s - %s", waiter_name, batch, e)
+
+
+def wait_for_endpoints(ec2client, vpcid, endpoint_ids):
+    """
+    DeleteVpcEndpoints only starts the deletes. Poll the vpc's endpoints until the given ones are gone or show
+    as deleted, so their interfaces have let go of the subnets and security groups. If they're still there
+    when we run out of attempts we say so and carry on
+    """
+    remaining = set(endpoint_ids)
+    if not remaining:
+        return
+    logger.info("Waiting on %s endpoints to delete", len(remaining))
+    sys.stdout.flush()
+    for attempt in range(ENDPOINT_POLL_ATTEMPTS):
+        remaining = {ep['VpcEndpointId'] for ep in describe_in_vpc(ec2client, 'describe_vpc_endpoints', vpcid)
+                     if ep['VpcEndpointId'] in remaining and ep['State'].lower() != 'deleted'}
+        if not remaining:
+            return
+        time.sleep(ENDPOINT_POLL_DELAY)
+    logger.error("Gave up waiting on endpoints to delete: %s", sorted(remaining))
+
+
+def fetch(prefetched, ec2client, operation, vpcid):
+    """
+    Take a describe's result from the prefetched futures if it was sent early, otherwise make the call now
+    """
+    if operation in prefetched:
+        return prefetched[operation].result()
+    return describe_in_vpc(ec2client, operation, vpcid)
+
+
+def route_destination(route):
+    """
+    Pick out whichever destination field a route was created with, keyed ready for DeleteRoute
+    """
+    for field in ('DestinationCidrBlock', 'DestinationIpv6CidrBlock', 'DestinationPrefixListId'):
+        if field in route:
+            return {field: route[field]}
+    return {}
+
+
+def sg_delete_order(sgs):
+    """
+    Work out an order to delete security groups in so that no group goes while another group's rules still
+    point at it. Returns waves of groups that can each be deleted in parallel, plus any groups caught up in a
+    reference cycle (or only referenced from one), which have no safe order
+    """
+    by_id = {sg['GroupId']: sg for sg in sgs}
+    references = {sg['GroupId']: {pair['GroupId']
+                                  for permission in sg['IpPermissions'] + sg['IpPermissionsEgress']
+                                  for pair in permission.get('UserIdGroupPairs', [])
+                                  if pair.get('GroupId') in by_id and pair['GroupId'] != sg['GroupId']}
+                  for sg in sgs}
+    referenced_by = {group_id: 0 for group_id in by_id}
+    for targets in references.values():
+        for target in targets:
+            referenced_by[target] += 1
+
+    # Kahn's algorithm - anything nobody points at can go, which in turn frees up whatever it pointed at
+    waves = []
+    wave = [group_id for group_id, count in referenced_by.items() if count == 0]
+    while wave:
+        waves.append([by_id[group_id] for group_id in wave])
+        next_wave = []
+        for group_id in wave:
+            for target in references[group_id]:
+                referenced_by[target] -= 1
+                if referenced_by[target] == 0:
+                    next_wave.append(target)
+        wave = next_wave
+    ordered = {sg['GroupId'] for wave in waves for sg in wave}
+    return waves, [sg for sg in sgs if sg['GroupId'] not in ordered]
+
+
+def terminate_instances(ec2client, instance_ids):
+    """
+    Terminate instances a batch at a time. TerminateInstances is all or nothing, so one protected or vanished
+    instance sinks its whole batch - those batches go again an instance at a time so the rest still get
+    terminated. Returns the ids that were terminated
+    """
+    batches = {f"terminate {len(batch)} instances from {batch[0]}": batch for batch in chunked(instance_ids, MAX_BATCH)}
+    failed = run_parallel([(description, partial(ec2client.terminate_instances, InstanceIds=batch))
+                           for description, batch in batches.items()], retried=True)
+    singles = {f"terminate {instance_id}": instance_id
+               for description in failed
+               for instance_id in batches[description]}
+    failed = run_parallel([(description, partial(ec2client.terminate_instances, InstanceIds=[instance_id]))
+                           for description, instance_id in singles.items()])
+    not_terminated = {singles[description] for description in failed}
+    return [instance_id for instance_id in instance_ids if instance_id not in not_terminated]
+
+
+def revoke_sg_rules(ec2client, sg):
     """
-    Clear the cruft from a VPC
+    Revoke a security group's rules, skipping the call for whichever direction has none. Rules that an
+    earlier attempt already revoked don't count as a failure, and don't stop the other direction being revoked
+    """
+    for revoke, permissions in ((ec2client.revoke_security_group_ingress, sg['IpPermissions']),
+                                (ec2client.revoke_security_group_egress, sg['IpPermissionsEgress'])):
+        if not permissions:
+            continue
+        try:
+            revoke(GroupId=sg['GroupId'], IpPermissions=permissions)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidPermission.NotFound':
+                raise
+
+
+def strip_and_delete_sg(ec2client, sg):
+    """
+    Revoke a security group's rules and then delete it
+    """
+    revoke_sg_rules(ec2client, sg)
+    ec2client.delete_security_group(GroupId=sg['GroupId'])
+
+
+def delete_sgs(ec2client, sgs):
+    """
+    Strip and delete a batch of security groups in parallel, handing back the groups that wouldn't go
+    """
+    by_description = {f"security group {sg['GroupId']}": sg for sg in sgs}
+    jobs = [(description, partial(strip_and_delete_sg, ec2client, sg)) for description, sg in by_description.items()]
+    return [by_description[description] for description in run_parallel(jobs)]
+
+
+def delete_interface(ec2client, interface_id):
+    """
+    Delete a network interface from the up front snapshot. Interfaces that went with their instance or
+    nat gateway in the meantime are already gone, which is what we wanted anyway
+    """
+    try:
+        ec2client.delete_network_interface(NetworkInterfaceId=interface_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidNetworkInterfaceID.NotFound':
+            raise
+
+
+def detach_and_delete_igw(ec2client, vpcid, i_gateway):
+    """
+    Detach an internet gateway from the VPC and then delete it
+    """
+    ec2client.detach_internet_gateway(InternetGatewayId=i_gateway, VpcId=vpcid)
+    ec2client.delete_internet_gateway(InternetGatewayId=i_gateway)
+
+
+def vpc_cleanup(ec2client, vpcid, dry_run):
+    """
+    Clear the cruft from a VPC. Each stage runs its deletes concurrently on the thread pool, but the
+    stages themselves run in order so that dependencies are gone before the things that need them
     """
     if not vpcid:
-        print('VPC id was not provided. Exiting')
+        logger.warning('VPC id was not provided. Exiting')
         return
-    print(f'Starting to Removing VPC artefacts: {vpcid}')
-    vpc = ec2.Vpc(vpcid)
+    logger.info('Starting to Removing VPC artefacts: %s', vpcid)
 
-    # START NUKING STUFF
+    # Take a single snapshot of the subnets, instances and interfaces up front and drive every stage off it
+    # rather than going back to AWS for the same lists each time. It also lets us note which elastic ips
+    # belong to the vpc before terminating the instances detaches them. The describes don't depend on each
+    # other so they go out on the pool together. Nothing changes underneath a dry run, so there every other
+    # stage's describe goes out with them too rather than waiting its turn
+    operations = VPC_DESCRIBES if dry_run else SNAPSHOT_DESCRIBES
+    prefetched = {operation: pool.submit(describe_in_vpc, ec2client, operation, vpcid) for operation in operations}
+    addresses_future = pool.submit(ec2client.describe_addresses, Filters=[{'Name': 'domain', 'Values': ['vpc']}])
+    subnets = fetch(prefetched, ec2client, 'describe_subnets', vpcid)
+    instance_ids = [instance['InstanceId']
+                    for reservation in fetch(prefetched, ec2client, 'describe_instances', vpcid)
+                    for instance in reservation['Instances']]
+    interfaces = fetch(prefetched, ec2client, 'describe_network_interfaces', vpcid)
+    eips = vpc_eips(interfaces, addresses_future.result()['Addresses'], vpcid)
 
-    # bin instances
-    for subnet in vpc.subnets.all():
-        for instance in subnet.instances.all():
-            print(f"Deleting the following Instance: {instance}")
-            if not dry_run:
-                instance.terminate()
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-
-    # bin routing tables
-    for rt in vpc.route_tables.all():
-        for rta in rt.associations:
-            print(f"Deleting the following routing table associations: {rta}", end='.....')
-            if not rta.main and not dry_run:
-                try:
-                    rta.delete()
-                    print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-                except ClientError as e:
-                    print(Fore.RED + f"Failed to delete route table associations: {rta} - {e}" + Fore.RESET)
-                    pass
-        for r in rt.routes:
-            print(f"Deleting the following routing table routes: {r}")
-            if not dry_run:
-                try:
-                    r.delete()
-                    print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-                except ClientError as e:
-                    print(Fore.RED + f"Failed to delete route: {r} - {e}" + Fore.RESET)
-                    pass
-        print(f"Deleting the routing table: {rt}")
-        if not dry_run:
+    # Tag the addresses with the vpc before anything detaches them, so if releasing one fails a re-run can
+    # still tie it back to this vpc
+    if not dry_run:
+        for batch in chunked(eips, MAX_BATCH):
             try:
-                rt.delete()
-                print(Fore.GREEN + f"Successfully Completed" + Fore.RESET)
+                ec2client.create_tags(Resources=batch, Tags=[{'Key': EIP_TAG, 'Value': vpcid}])
             except ClientError as e:
-                print(Fore.RED + f"Failed to delete routing table: {rt} - {e}" + Fore.RESET)
-                pass
+                logger.warning("Could not tag elastic ips %s with their vpc - %s", batch, e)
 
-    # bin internet gateways
-    i_gateways = client.describe_internet_gateways(Filters=filt).get("InternetGateways")
-    for i_gateway in i_gateways:
-        i_gateway = i_gateway['InternetGatewayId']
-        print(f"Deleting internet gateway - {i_gateway}")
-        if not dry_run:
-            try:
-                vpc.detach_internet_gateway(InternetGatewayId=i_gateway)
-                ec2.InternetGateway(i_gateway).delete()
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-            except ClientError as e:
-                print(Fore.RED + f'Dependency error with internet gateway: {i_gateway} - {e}' + Fore.RESET)
+    # START NUKING STUFF
+
+    # bin instances. TerminateInstances takes a batch of ids so there's no need for a call per instance
+    for instance_id in instance_ids:
+        logger.info("Deleting the following Instance: %s", instance_id)
+    terminated = []
+    if not dry_run:
+        terminated = terminate_instances(ec2client, instance_ids)
+
+    # bin routing tables. Associations and routes have to go before the table itself. The main table and
+    # the local routes can't be removed by hand - they go when the vpc does
+    route_tables = [rt for rt in fetch(prefetched, ec2client, 'describe_route_tables', vpcid)
+                    if not any(rta['Main'] for rta in rt['Associations'])]
+    jobs = []
+    for rt in route_tables:
+        for rta in rt['Associations']:
+            logger.info("Deleting the following routing table associations: %s", rta['RouteTableAssociationId'])
+            jobs.append((f"route table association {rta['RouteTableAssociationId']}",
+                         partial(ec2client.disassociate_route_table,
+                                 AssociationId=rta['RouteTableAssociationId'])))
+    if not dry_run:
+        run_parallel(jobs)
+    jobs = []
+    for rt in route_tables:
+        for r in rt['Routes']:
+            if r.get('GatewayId') == 'local':
+                continue
+            destination = route_destination(r)
+            logger.info("Deleting the following routing table routes: %s in %s", destination, rt['RouteTableId'])
+            jobs.append((f"route {destination} in {rt['RouteTableId']}",
+                         partial(ec2client.delete_route, RouteTableId=rt['RouteTableId'], **destination)))
+    if not dry_run:
+        run_parallel(jobs)
+    jobs = []
+    for rt in route_tables:
+        logger.info("Deleting the routing table: %s", rt['RouteTableId'])
+        jobs.append((f"routing table {rt['RouteTableId']}",
+                     partial(ec2client.delete_route_table, RouteTableId=rt['RouteTableId'])))
+    if not dry_run:
+        run_parallel(jobs)
 
     # bin nat gateways
-    gw_filter = [{'Name': 'vpc-id', 'Values': [vpcid]}]
-    gateways = client.describe_nat_gateways(Filters=gw_filter).get("NatGateways")
+    gateways = fetch(prefetched, ec2client, 'describe_nat_gateways', vpcid)
+    jobs = {}
     for gateway in gateways:
         gateway = str(gateway['NatGatewayId'])
-        print(f"Deleting NAT gateway - {gateway}")
-        if not dry_run:
+        logger.info("Deleting NAT gateway - %s", gateway)
+        jobs[f"nat gateway {gateway}"] = (gateway, partial(ec2client.delete_nat_gateway, NatGatewayId=gateway))
+    deleted_gateways = []
+    if not dry_run:
+        failed = run_parallel([(description, job) for description, (gateway, job) in jobs.items()])
+        deleted_gateways = [gateway for description, (gateway, job) in jobs.items() if description not in failed]
+
+    # release elastic ips. There's no bulk release so these stay one call apiece on the pool. Instances and nat
+    # gateways only let go of their addresses once they're fully gone, and an address can't be released while
+    # it's still associated, so wait for them first
+    for eip in eips:
+        logger.info("Releasing Elastic IP: %s", eip)
+    if not dry_run:
+        wait_for(ec2client, 'instance_terminated', 'InstanceIds', terminated)
+        wait_for(ec2client, 'nat_gateway_deleted', 'NatGatewayIds', deleted_gateways)
+        run_parallel([(f"elastic ip {eip}", partial(ec2client.release_address, AllocationId=eip)) for eip in eips])
+
+    # bin internet gateways. Detaching is refused while the vpc still has live instances or mapped public
+    # addresses, so this waits until the instances are terminated and the elastic ips released
+    i_gateways = fetch(prefetched, ec2client, 'describe_internet_gateways', vpcid)
+    jobs = []
+    for i_gateway in i_gateways:
+        i_gateway = i_gateway['InternetGatewayId']
+        logger.info("Deleting internet gateway - %s", i_gateway)
+        jobs.append((f"internet gateway {i_gateway}", partial(detach_and_delete_igw, ec2client, vpcid, i_gateway)))
+    if not dry_run:
+        run_parallel(jobs)
+
+    # bin endpoints. DeleteVpcEndpoints takes the whole list in one go and reports per endpoint failures
+    endpoint_ids = []
+    for ep in fetch(prefetched, ec2client, 'describe_vpc_endpoints', vpcid):
+        logger.info("Deleting endpoint: %s", ep)
+        endpoint_ids.append(ep['VpcEndpointId'])
+    if not dry_run:
+        deleting = []
+        for batch in chunked(endpoint_ids, MAX_BATCH):
             try:
-                client.delete_nat_gateway(NatGatewayId=gateway)
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
+                unsuccessful = ec2client.delete_vpc_endpoints(VpcEndpointIds=batch).get('Unsuccessful', [])
+                for item in unsuccessful:
+                    logger.error("Failed to delete endpoint: %s - %s", item['ResourceId'], item['Error']['Message'])
+                if not unsuccessful:
+                    logger.info(OK)
+                failed = {item['ResourceId'] for item in unsuccessful}
+                deleting += [endpoint_id for endpoint_id in batch if endpoint_id not in failed]
             except ClientError as e:
-                print(Fore.RED + f'Dependency error with nat gateway: {gateway} - {e}' + Fore.RESET)
+                logger.error("Failed to delete endpoints: %s - %s", batch, e)
+        wait_for_endpoints(ec2client, vpcid, deleting)
 
-    # release elastic ips
-    for eip_list in client.describe_addresses(Filters=filt)['Addresses']:
-        eip = eip_list['AllocationId']
-        print(f"Releasing Elastic IP: {eip}")
-        if not dry_run:
-            try:
-                client.release_address(AllocationId=eip)
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-            except ClientError:
-                print(Fore.RED + f'Dependency error with elastic ip: {eip}' + Fore.RESET)
+    # bin network interfaces. Instances and endpoints have to be gone before their interfaces will let go, and
+    # anything left holding on to an interface blocks its subnet and security groups from going. Requester
+    # managed interfaces (endpoints, load balancers, lambdas and the like) can't be deleted by us at all - they
+    # go with the service that owns them
+    jobs = []
+    for interface in interfaces:
+        if interface.get('RequesterManaged'):
+            logger.info("Leaving requester managed interface: %s (%s)", interface['NetworkInterfaceId'],
+                        interface.get('Description', ''))
+            continue
+        logger.info("Deleting interface: %s", interface['NetworkInterfaceId'])
+        jobs.append((f"network interface {interface['NetworkInterfaceId']}",
+                     partial(delete_interface, ec2client, interface['NetworkInterfaceId'])))
+    if not dry_run:
+        run_parallel(jobs)
 
     # bin subnets
-    for subnet in vpc.subnets.all():
-        print(f"Deleting subnet: {subnet}")
-        if not dry_run:
-            try:
-                subnet.delete()
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-            except ClientError:
-                print(Fore.RED + f'Dependency error with {subnet}' + Fore.RESET)
-
-    # bin endpoints
-    for ep in ec2client.describe_vpc_endpoints(
-            Filters=[{
-                'Name': 'vpc-id',
-                'Values': [vpcid]
-            }])['VpcEndpoints']:
-        print(f"Deleting endpoint: {ep}")
-        if not dry_run:
-            ec2client.delete_vpc_endpoints(VpcEndpointIds=[ep['VpcEndpointId']])
-
-    # bin security groups
-    sg_failures = []
-    for sg in vpc.security_groups.all():
-        if sg.group_name != 'default':
-            print(f"Deleting Security Group Rules: {sg}")
-            if not dry_run:
-                try:
-                    if sg.ip_permissions:
-                        sg.revoke_ingress(IpPermissions=sg.ip_permissions)
-                        sg.revoke_egress(IpPermissions=sg.ip_permissions)
-                    sg.delete()
-                    print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-                except ClientError as f:
-                    print(Fore.RED + f'Dependency error with {sg} - will have another go' + Fore.RESET)
-                    sg_failures.append(sg)
-
-    # We sometimes get interdependency issues. Have another go with the array reversed
-    if len(sg_failures) > 0:
-        sg_failures.reverse()
+    jobs = []
+    for subnet in subnets:
+        logger.info("Deleting subnet: %s", subnet['SubnetId'])
+        jobs.append((f"subnet {subnet['SubnetId']}", partial(ec2client.delete_subnet, SubnetId=subnet['SubnetId'])))
+    if not dry_run:
+        run_parallel(jobs)
+
+    # bin security groups. Groups referencing each other used to need a second pass, so instead they go in
+    # dependency order - each wave only holds groups that nothing left standing still points at
+    sgs = [sg for sg in fetch(prefetched, ec2client, 'describe_security_groups', vpcid)
+           if sg['GroupName'] != 'default']
+    for sg in sgs:
+        logger.info("Deleting Security Group Rules: %s", sg['GroupId'])
+    waves, tangled = sg_delete_order(sgs)
+    if not dry_run:
+        # There's no safe order through a cycle, so strip the rules off every group in it up front and let
+        # them go as one last wave with nothing left to revoke
+        if tangled:
+            run_parallel([(f"security group rules {sg['GroupId']}", partial(revoke_sg_rules, ec2client, sg))
+                          for sg in tangled])
+            waves.append([dict(sg, IpPermissions=[], IpPermissionsEgress=[]) for sg in tangled])
+        sg_failures = []
+        for wave in waves:
+            sg_failures += delete_sgs(ec2client, wave)
+
+        # With the groups in dependency order this only has work to do when something outside the groups was
+        # holding one up. Give those one more go, keeping to wave order so a group still referenced by another
+        # failure only goes after it
         for failure in sg_failures:
-            try:
-                if failure.ip_permissions:
-                    failure.revoke_ingress(IpPermissions=failure.ip_permissions)
-                    failure.revoke_egress(IpPermissions=failure.ip_permissions)
-                failure.delete()
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-            except ClientError as f:
-                print(Fore.RED + f'Could not rectify the dependency error with {failure}. Rectify manually then retry'
-                      + Fore.RESET)
-                # sys.exit()
-
-    # bin network interfaces
-    for subnet in vpc.subnets.all():
-        for interface in subnet.network_interfaces.all():
-            print(f"Deleting interface: {interface}")
-            if not dry_run:
-                try:
-                    interface.delete()
-                    print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-                except ClientError:
-                    print(Fore.RED + f'Dependency error with network interface: {interface}' + Fore.RESET)
+            if delete_sgs(ec2client, [failure]):
+                logger.error("Could not delete security group %s. Rectify manually then retry", failure['GroupId'])
 
     # bin any vpc peering connections
-    vpc_failures = []
-    for vpcpeer in ec2client.describe_vpc_peering_connections(
-            Filters=[{
-                'Name': 'requester-vpc-info.vpc-id',
-                'Values': [vpcid]
-            }])['VpcPeeringConnections']:
-        print(f"Deleting peer connection: {vpcpeer}")
-        if not dry_run:
-            try:
-                ec2.VpcPeeringConnection(vpcpeer['VpcPeeringConnectionId']).delete()
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
-            except ClientError as e:
-                print(Fore.RED + f'Dependency error with {vpcpeer}' + Fore.RESET)
-                vpc_failures.append(vpcpeer)
+    jobs = []
+    for vpcpeer in fetch(prefetched, ec2client, 'describe_vpc_peering_connections', vpcid):
+        logger.info("Deleting peer connection: %s", vpcpeer)
+        jobs.append((f"peer connection {vpcpeer['VpcPeeringConnectionId']}",
+                     partial(ec2client.delete_vpc_peering_connection,
+                             VpcPeeringConnectionId=vpcpeer['VpcPeeringConnectionId'])))
+    if not dry_run:
+        run_parallel(jobs)
 
     # bin non-default network acls
-    for netacl in vpc.network_acls.all():
-        if not netacl.is_default:
-            print(f"Deleting ACL: {netacl}")
-            if not dry_run:
-                netacl.delete()
-                print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
+    jobs = []
+    for netacl in fetch(prefetched, ec2client, 'describe_network_acls', vpcid):
+        if not netacl['IsDefault']:
+            logger.info("Deleting ACL: %s", netacl['NetworkAclId'])
+            jobs.append((f"ACL {netacl['NetworkAclId']}",
+                         partial(ec2client.delete_network_acl, NetworkAclId=netacl['NetworkAclId'])))
+    if not dry_run:
+        run_parallel(jobs)
 
     # finally, bin the vpc
-    print(f"Deleting the VPC: {vpcid}")
+    logger.info("Deleting the VPC: %s", vpcid)
     if not dry_run:
         try:
             ec2client.delete_vpc(VpcId=vpcid)
-            print(Fore.GREEN + f"Succesfully Completed" + Fore.RESET)
+            logger.info(OK)
         except ClientError as e:
-            print(Fore.RED + f"Could not delete the VPC: {vpcid}" + Fore.RESET)
+            logger.error("Could not delete the VPC: %s", vpcid)
+
+
+def main():
+    """
+    Build the AWS clients once and run the cleanup against every vpc that matches the filter
+    """
+    args = parse_args()
+
+    # Let stdout buffer up the per resource status lines and flush once each vpc is done, instead of paying
+    # for a write every line while the pool threads are trying to get on with the api calls
+    sys.stdout.reconfigure(line_buffering=False)
+    handler = StatusHandler(sys.stdout)
+    handler.setFormatter(ColourFormatter('%(message)s'))
+    # Only our own logger gets the handler, so botocore's chatter stays out of the status lines
+    logger.addHandler(handler)
+    logger.setLevel(logging.WARNING if args.quiet else logging.INFO)
+    logger.propagate = False
+
+    # A single session and client, reused for every call so the service model is only parsed the once
+    session = boto3.Session(profile_name=args.profile_name)
+    ec2client = session.client('ec2', region_name=args.aws_region, config=boto_config)
+    rgta = session.client('resourcegroupstaggingapi', region_name=args.aws_region, config=boto_config)
+
+    # Search by filter for the cluster name and add the vpc Ids to an array
+    try:
+        vpc_ids = find_vpcs(rgta, args.filter_term)
+    except ClientError as e:
+        logger.error("Unable to connect to AWS - check that you have valid creds. Refresh if necessary.")
+        sys.exit()
+
+    # Iterate through our matching vpcs through the cleanup function. find_vpcs hands back the ids as plain
+    # strings so there's nothing to pick out of a resource repr
+    for vpcid in vpc_ids:
+        vpc_cleanup(ec2client, vpcid, args.dry_run)
+        logger.info('\n\nVPC %s Complete\n\n', vpcid)
+        sys.stdout.flush()
 
 
 if __name__ == '__main__':
-    # Iterate through our matching vpcs through the cleanup function
-    for my_vpc in vpcs:
-        target = str(my_vpc).split("'")[1]
-        vpc_cleanup(target)
-        print(f'\n\nVPC {target} Complete\n\n')
+    main()